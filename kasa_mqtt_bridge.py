@@ -28,12 +28,15 @@ import asyncio
 import yaml
 import aiomqtt
 import platform
-import json
+import orjson
 import re
 import logging
+import math
 import sys
 import signal
-from datetime import datetime, timedelta
+import socket
+from dataclasses import dataclass
+from datetime import datetime
 from kasa import Discover, Credentials
 
 # --- Logging minimale (alzalo se vuoi: INFO/DEBUG) ---
@@ -43,6 +46,33 @@ logging.basicConfig(
 )
 
 # --- Caricamento & validazione config ---
+@dataclass(frozen=True, slots=True)
+class BridgeConfig:
+    """Valori di config.yaml letti una volta all'avvio (niente lookup su dict nei loop)."""
+    mqtt_host: str
+    mqtt_port: int
+    mqtt_user: str | None
+    mqtt_password: str | None
+    base_topic: str
+    kasa_email: str
+    kasa_password: str
+    poll_interval: float
+    discovery_jobs: tuple
+
+    @classmethod
+    def from_dict(cls, config):
+        return cls(
+            mqtt_host=config['mqtt']['host'],
+            mqtt_port=config['mqtt']['port'],
+            mqtt_user=config['mqtt'].get('user'),
+            mqtt_password=config['mqtt'].get('password'),
+            base_topic=config['mqtt']['base_topic'],
+            kasa_email=config['kasa']['email'],
+            kasa_password=config['kasa']['password'],
+            poll_interval=config.get('poll_interval', 60),
+            discovery_jobs=tuple(config.get('discovery_jobs') or ()),
+        )
+
 try:
     with open('config.yaml', 'r') as f:
         config = yaml.safe_load(f)
@@ -54,171 +84,296 @@ try:
             if not isinstance(d, dict) or k not in d:
                 raise KeyError(f"Config mancante: {'.'.join(path)}")
             d = d[k]
+    cfg = BridgeConfig.from_dict(config)
 except (FileNotFoundError, KeyError) as e:
     logging.error(f"Errore critico di configurazione: {e}")
     sys.exit(2)  # non-zero -> systemd Restart=on-failure
 
 # --- Utilità ---
+# tipo del valore -> True se va pubblicato come nome (enum), calcolato una volta per tipo.
+# La cache è per tipo e non per feature: una feature può valere None e poi un enum.
+_NAMED_TYPES = {}
+
 def get_feature_value(feature):
     """Estrae il valore da un oggetto Feature in modo sicuro."""
-    if not hasattr(feature, 'value'):
+    try:
+        raw_value = feature.value
+    except AttributeError:
         return None
-    raw_value = feature.value
-    if hasattr(raw_value, 'name') and not isinstance(raw_value, (str, int, float, bool)):
+    value_type = type(raw_value)
+    named = _NAMED_TYPES.get(value_type)
+    if named is None:
+        named = _NAMED_TYPES[value_type] = (
+            hasattr(raw_value, 'name') and not isinstance(raw_value, (str, int, float, bool))
+        )
+    if named:
         return raw_value.name.lower()
     return raw_value
 
+def value_applied(read_value, requested, previous):
+    """True se il valore riletto dopo un comando può considerarsi applicato.
+
+    Tollerante verso arrotondamenti/clamp del dispositivo, maiuscole negli enum e
+    feature non rileggibili (None): in quei casi non ha senso continuare a rileggere.
+    """
+    if read_value is None or read_value != previous:
+        return True
+    if isinstance(read_value, bool) or isinstance(requested, bool):
+        return read_value == requested
+    if isinstance(read_value, (int, float)) and isinstance(requested, (int, float)):
+        return math.isclose(read_value, requested, abs_tol=0.5)
+    if isinstance(read_value, str) and isinstance(requested, str):
+        return read_value.lower() == requested.lower()
+    return read_value == requested
+
+def device_state(dev, state_scratch):
+    """Stato del dispositivo come dict {feature: valore}, senza i valori None.
+
+    Il dict restituito (preso da state_scratch, device_id -> dict) è riusato alla
+    chiamata successiva per lo stesso dispositivo:
+    va serializzato subito, senza await in mezzo. L'ordine delle chiavi è quello
+    (stabile) di dev.features, quindi a valori invariati il JSON resta identico.
+    """
+    state_json = state_scratch.setdefault(dev.device_id, {})
+    state_json.clear()
+    for n, f in dev.features.items():
+        v = get_feature_value(f)
+        if v is not None:
+            state_json[n] = v
+    return state_json
+
+_WS_RE = re.compile(r'\s+')
+_ALIAS_RE = re.compile(r'[^a-z0-9_-]+')
+
 def sanitize_alias(alias):
     """Pulisce l'alias per usarlo in un topic MQTT."""
-    s = str(alias or "").lower()
-    s = re.sub(r'\s+', '_', s)
-    s = re.sub(r'[^a-z0-9_-]', '', s)
-    return s
+    return _ALIAS_RE.sub('', _WS_RE.sub('_', str(alias or "").lower()))
 
 async def a_wait_for(coro, timeout, what="operazione"):
-    """Wrapper con timeout e messaggio chiaro."""
+    """Wrapper con timeout e messaggio chiaro (senza creare un Task come wait_for)."""
     try:
-        return await asyncio.wait_for(coro, timeout=timeout)
-    except asyncio.TimeoutError:
+        async with asyncio.timeout(timeout):
+            return await coro
+    except TimeoutError:
         raise RuntimeError(f"Timeout {timeout}s durante {what}")
 
+async def update_hub(hub, hub_locks, coalesce=False, what="update hub"):
+    """Update dell'hub serializzato da un lock per hub (mai due update in volo).
+
+    Con coalesce=True, se un update è già in corso lo si attende e si riusa lo stato
+    appena letto invece di farne un altro; se quell'update è fallito se ne fa uno nuovo.
+    hub_locks: device_id hub -> {"lock": asyncio.Lock, "ok": esito dell'ultimo update}.
+    """
+    entry = hub_locks.get(hub.device_id)
+    if entry is None:
+        entry = hub_locks[hub.device_id] = {"lock": asyncio.Lock(), "ok": False}
+    lock = entry["lock"]
+    if coalesce and lock.locked():
+        async with lock:
+            if entry["ok"]:
+                return
+    async with lock:
+        # resta False se l'update fallisce, va in timeout o viene cancellato
+        entry["ok"] = False
+        await a_wait_for(hub.update(), timeout=10, what=what)
+        entry["ok"] = True
+
+def enqueue_publish(pub_queue, topic, payload, retain=True):
+    """Accoda una publish per publisher_task; ritorna False se la coda è piena."""
+    try:
+        pub_queue.put_nowait((topic, payload, retain))
+        return True
+    except asyncio.QueueFull:
+        logging.warning(f"Coda publish piena, messaggio scartato su {topic}")
+        return False
+
 def _safe_topic(obj):
     """aiomqtt può dare topic come str o oggetto; normalizza a str."""
     return getattr(obj, "value", obj)
 
 # --- Task Principali ---
-async def discovery_task(kasa_devices, device_map, reverse_device_map):
-    """Scoperta periodica dispositivi Kasa secondo discovery_jobs."""
-    creds = Credentials(username=config['kasa']['email'], password=config['kasa']['password'])
-    jobs = config.get('discovery_jobs', [])
-    next_scan_times = [datetime.now()] * len(jobs)
+async def _run_discovery_job(i, job):
+    """Esegue un singolo discovery_job e ritorna i dispositivi trovati {ip: dev} (senza login)."""
+    job_type = job.get("type")
+    logging.info(f"Esecuzione Job di Scoperta {i+1} (Tipo: {job_type})")
+    temp_found_devices = {}
+
+    if job_type == "broadcast":
+        timeout = job.get("timeout", 5)
+        try:
+            discovered = await a_wait_for(Discover.discover(timeout=timeout),
+                                          timeout=timeout+2, what="discover broadcast")
+            for ip, dev in discovered.items():
+                temp_found_devices[ip] = dev
+        except Exception as e:
+            logging.error(f"Errore discover broadcast: {e}")
 
-    while True:
-        now = datetime.now()
-        for i, job in enumerate(jobs):
-            if now < next_scan_times[i]:
-                continue
+    elif job_type == "host":
+        target_ip = job.get("target")
+        if target_ip:
+            try:
+                dev = await a_wait_for(Discover.discover_single(target_ip),
+                                       timeout=10, what=f"discover host {target_ip}")
+                temp_found_devices[dev.host] = dev
+            except Exception:
+                logging.warning(f"Nessun dispositivo trovato a {target_ip}.")
 
-            job_type = job.get("type")
-            logging.info(f"Esecuzione Job di Scoperta {i+1} (Tipo: {job_type})")
-            temp_found_devices = {}
+    return temp_found_devices
 
-            if job_type == "broadcast":
-                timeout = job.get("timeout", 5)
-                try:
-                    discovered = await a_wait_for(Discover.discover(timeout=timeout),
-                                                  timeout=timeout+2, what="discover broadcast")
-                    for ip, dev in discovered.items():
-                        temp_found_devices[ip] = dev
-                except Exception as e:
-                    logging.error(f"Errore discover broadcast: {e}")
-
-            elif job_type == "host":
-                target_ip = job.get("target")
-                if target_ip:
-                    try:
-                        dev = await a_wait_for(Discover.discover_single(target_ip),
-                                               timeout=10, what=f"discover host {target_ip}")
-                        temp_found_devices[dev.host] = dev
-                    except Exception:
-                        logging.warning(f"Nessun dispositivo trovato a {target_ip}.")
-
-            # Autenticazione e aggiunta mappa
-            for ip, found_dev in temp_found_devices.items():
-                if ip in [d.host for d in kasa_devices.values()]:
-                    continue
-                logging.info(f"Nuovo IP {ip} ({found_dev.model}). TENTO login...")
-                try:
-                    dev = await a_wait_for(Discover.discover_single(ip, credentials=creds),
-                                           timeout=10, what=f"discover device {ip}")
-                    await a_wait_for(dev.update(), timeout=10, what=f"update {ip}")
-
-                    is_hub = "KH100" in getattr(dev, "model", "")
-                    if is_hub:
-                        logging.info(f"È un Hub '{dev.alias}'. Cerco i figli...")
-                        for child in getattr(dev, "children", []):
-                            if child.device_id not in kasa_devices:
-                                alias = sanitize_alias(child.alias)
-                                unique_name = f"{alias}_{child.device_id[-8:]}"
-                                kasa_devices[child.device_id] = child
-                                device_map[child.device_id] = unique_name
-                                reverse_device_map[unique_name] = child.device_id
-                                logging.info(f"Figlio aggiunto: '{child.alias}' -> {unique_name}")
+async def discovery_task(kasa_devices, device_map, reverse_device_map, hub_refs, hub_to_children):
+    """Scoperta periodica dispositivi Kasa secondo discovery_jobs."""
+    creds = Credentials(username=cfg.kasa_email, password=cfg.kasa_password)
+    jobs = cfg.discovery_jobs
+    known_hosts = set()  # host dei dispositivi già in kasa_devices
+    in_login = set()     # IP con login in corso (più job possono trovare lo stesso IP)
+
+    async def _login_and_add(ip, found_dev):
+        """Autenticazione e aggiunta mappa per un nuovo IP."""
+        logging.info(f"Nuovo IP {ip} ({found_dev.model}). TENTO login...")
+        try:
+            dev = await a_wait_for(Discover.discover_single(ip, credentials=creds),
+                                   timeout=10, what=f"discover device {ip}")
+            await a_wait_for(dev.update(), timeout=10, what=f"update {ip}")
+
+            is_hub = "KH100" in getattr(dev, "model", "")
+            if is_hub:
+                logging.info(f"È un Hub '{dev.alias}'. Cerco i figli...")
+                # chiave stabile: un nuovo login dello stesso hub sostituisce la voce
+                hub_key = dev.device_id
+                hub_refs[hub_key] = dev
+                children = getattr(dev, "children", [])
+                # hub senza figli: resta da riscansionare, per trovare i sensori associati dopo;
+                # con la chiave stabile il nuovo login sostituisce la voce invece di accumularla
+                if children:
+                    known_hosts.add(ip)
+                for child in children:
+                    if child.device_id in kasa_devices:
+                        # figlio già noto: lo ricolleghiamo all'oggetto hub corrente
+                        kasa_devices[child.device_id] = child
                     else:
-                        device_id = dev.device_id
-                        if device_id not in kasa_devices:
-                            alias = sanitize_alias(dev.alias)
-                            unique_name = f"{alias}_{device_id[-8:]}"
-                            kasa_devices[device_id] = dev
-                            device_map[device_id] = unique_name
-                            reverse_device_map[unique_name] = dev.device_id
-                            logging.info(f"Standalone aggiunto: '{dev.alias}' -> {unique_name}")
-
-                except Exception as e:
-                    logging.error(f"Login/update fallito per {ip}: {e}")
-
-            rescan = job.get("rescan_interval")
-            next_scan_times[i] = (now + timedelta(seconds=rescan)) if rescan else datetime.max
-
-        await asyncio.sleep(15)
-
-async def poll_kasa_devices(client, devices, dev_map):
-    """Polling periodico di tutti i dispositivi + publish stato su MQTT."""
-    base_topic = config['mqtt']['base_topic']
+                        alias = sanitize_alias(child.alias)
+                        unique_name = f"{alias}_{child.device_id[-8:]}"
+                        kasa_devices[child.device_id] = child
+                        device_map[child.device_id] = unique_name
+                        reverse_device_map[unique_name] = child.device_id
+                        hub_to_children.setdefault(hub_key, []).append(child.device_id)
+                        logging.info(f"Figlio aggiunto: '{child.alias}' -> {unique_name}")
+            else:
+                device_id = dev.device_id
+                if device_id not in kasa_devices:
+                    alias = sanitize_alias(dev.alias)
+                    unique_name = f"{alias}_{device_id[-8:]}"
+                    kasa_devices[device_id] = dev
+                    device_map[device_id] = unique_name
+                    reverse_device_map[unique_name] = dev.device_id
+                    known_hosts.add(ip)
+                    logging.info(f"Standalone aggiunto: '{dev.alias}' -> {unique_name}")
+
+        except Exception as e:
+            logging.error(f"Login/update fallito per {ip}: {e}")
+
+    async def _job_loop(i, job):
+        """Esegue il job e poi dorme esattamente fino alla prossima scansione."""
+        rescan = job.get("rescan_interval")
+        while True:
+            temp_found_devices = await _run_discovery_job(i, job)
+
+            nuovi = [(ip, found_dev) for ip, found_dev in temp_found_devices.items()
+                     if ip not in known_hosts and ip not in in_login]
+            in_login.update(ip for ip, _ in nuovi)
+            try:
+                await asyncio.gather(*(_login_and_add(ip, found_dev) for ip, found_dev in nuovi),
+                                     return_exceptions=True)
+            finally:
+                in_login.difference_update(ip for ip, _ in nuovi)
+
+            if not rescan:
+                return
+            await asyncio.sleep(rescan)
+
+    # un task per job: niente risvegli periodici solo per controllare l'orario
+    async with asyncio.TaskGroup() as tg:
+        for i, job in enumerate(jobs):
+            tg.create_task(_job_loop(i, job), name=f"discovery_job_{i+1}")
+
+async def poll_kasa_devices(devices, dev_map, hub_refs, hub_to_children, hub_locks, last_payload, state_scratch, pub_queue):
+    """Polling periodico di tutti i dispositivi + publish stato su MQTT (solo se cambiato)."""
+    base_topic = cfg.base_topic
+    poll_interval = cfg.poll_interval
+    # snapshot delle chiavi riusati tra i cicli: la discovery aggiunge o sostituisce
+    # ma non rimuove mai, quindi basta confrontare le dimensioni per sapere se
+    # vanno ricostruiti (gli oggetti si rileggono dal dict a ogni ciclo)
+    devices_view, hubs_view = (), ()
     while True:
-        poll_interval = config.get('poll_interval', 60)
         logging.info(f"Polling per {len(devices)} dispositivi...")
-
-        hubs_aggiornati = set()
-        for device_id in list(devices.keys()):
-            if device_id not in devices:
-                continue
-            dev = devices[device_id]
+        if len(devices_view) != len(devices):
+            devices_view = tuple(devices)
+        if len(hubs_view) != len(hub_refs):
+            hubs_view = tuple(hub_refs)
+
+        # 1) un solo update per hub, tutti gli hub in parallelo
+        hub_items = [(hub_key, hub_refs[hub_key]) for hub_key in hubs_view]
+        results = await asyncio.gather(
+            *(update_hub(hub, hub_locks, coalesce=True) for _, hub in hub_items),
+            return_exceptions=True,
+        )
+        da_saltare = set()
+        for (hub_key, hub), res in zip(hub_items, results):
+            if isinstance(res, Exception):
+                logging.error(f"Errore aggiornamento hub '{getattr(hub, 'alias', hub_key)}': {res}")
+                da_saltare.update(hub_to_children.get(hub_key, ()))
+
+        # 2) figli e standalone in parallelo, senza ulteriori refresh degli hub
+        async def _poll_one(device_id):
+            dev = devices.get(device_id)
+            if dev is None:
+                return
             device_name = dev_map.get(device_id, device_id[-8:])
 
             try:
-                hub = getattr(dev, "parent", None)
-                if hub is not None:
-                    hub_key = id(hub)
-                    if hub_key not in hubs_aggiornati:
-                        await a_wait_for(hub.update(), timeout=10, what="update hub")
-                        hubs_aggiornati.add(hub_key)
-
                 await a_wait_for(dev.update(), timeout=30, what=f"update device {device_name}")
 
-                state_json = {
-                    n: get_feature_value(f)
-                    for n, f in dev.features.items()
-                    if get_feature_value(f) is not None
-                }
+                state_json = device_state(dev, state_scratch)
                 state_topic = f"{base_topic}/{device_name}/state"
-                await a_wait_for(client.publish(state_topic, json.dumps(state_json), retain=True),
-                                 timeout=10, what=f"publish state {device_name}")
+                payload = orjson.dumps(state_json)
+                # il broker ha già lo stato retained: ripubblicare lo stesso payload è inutile
+                if last_payload.get(state_topic) == payload:
+                    return
+                # la publish vera la fa publisher_task: il polling non aspetta il broker
+                enqueue_publish(pub_queue, state_topic, payload)
 
             except Exception as e:
                 logging.error(f"Errore aggiornamento '{device_name}': {e}")
 
+        await asyncio.gather(*(_poll_one(d) for d in devices_view if d not in da_saltare),
+                             return_exceptions=True)
+
         logging.info(f"Fine ciclo. Prossimo tra {poll_interval}s.")
         await asyncio.sleep(poll_interval)
 
-async def handle_mqtt_messages(client, devices, rev_map):
+async def handle_mqtt_messages(client, devices, rev_map, hub_locks, state_scratch, pub_queue):
     """Gestione comandi MQTT: .../base_topic/<device>/set con payload JSON."""
-    base_topic = config['mqtt']['base_topic']
+    base_topic = cfg.base_topic
     command_topic_wildcard = f"{base_topic}/+/set/#"
     await client.subscribe(command_topic_wildcard)
     logging.info(f"Sottoscritto ai comandi su: {command_topic_wildcard}")
+    topic_prefix = f"{base_topic}/"
+    prefix_len = len(topic_prefix)
 
     async for message in client.messages:
         topic = "<unknown>"
         payload_str = ""
         try:
             topic = str(_safe_topic(message.topic))
-            parts = topic.split('/')
-            if len(parts) < 3:
+            # forma attesa: {base_topic}/{device}/set[/{feature}]
+            if not topic.startswith(topic_prefix):
+                logging.warning(f"Topic non valido: {topic}")
+                continue
+            device_name, _, rest = topic[prefix_len:].partition('/')
+            if rest != "set" and not rest.startswith("set/"):
                 logging.warning(f"Topic non valido: {topic}")
                 continue
 
-            device_name = parts[1]
             if device_name not in rev_map:
                 logging.warning(f"Device '{device_name}' non riconosciuto per topic {topic}")
                 continue
@@ -233,12 +388,12 @@ async def handle_mqtt_messages(client, devices, rev_map):
             logging.info(f"Cmd per '{device_name}': {payload_str}")
 
             # 🔧 1️⃣ Determina il target feature dal topic (es. /set/state o /set/target_temperature)
-            feature_from_topic = parts[3] if len(parts) >= 4 else "state"
+            feature_from_topic = rest[4:].partition('/')[0] or "state"
 
             # 🔧 2️⃣ Prova a interpretare il payload in modo flessibile
             try:
-                parsed = json.loads(payload_str)
-            except json.JSONDecodeError:
+                parsed = orjson.loads(payload_str)
+            except orjson.JSONDecodeError:
                 # tenta interpretazione diretta (true/false/numero/stringa)
                 if payload_str.lower() in ("true", "on"):
                     parsed = {feature_from_topic: True}
@@ -258,16 +413,27 @@ async def handle_mqtt_messages(client, devices, rev_map):
             # 🔧 4️⃣ Applica i comandi
             for feature_name, new_value in parsed.items():
                 if feature_name in dev.features and hasattr(dev.features[feature_name], 'set_value'):
+                    previous = get_feature_value(dev.features[feature_name])
                     await a_wait_for(dev.features[feature_name].set_value(new_value), timeout=10, what=f"set {feature_name} on {device_name}")
 
                     # aggiorna stato dopo comando
                     if hasattr(dev, 'parent') and dev.parent:
-                        await asyncio.sleep(1)
-                        await a_wait_for(dev.parent.update(), timeout=10, what="confirm hub update")
-
-                        state_json = {n: get_feature_value(f) for n, f in dev.features.items() if get_feature_value(f) is not None}
-                        state_topic = f"{config['mqtt']['base_topic']}/{device_name}/state"
-                        await a_wait_for(client.publish(state_topic, json.dumps(state_json), retain=True), timeout=10, what=f"publish confirm {device_name}")
+                        # rilegge l'hub finché il nuovo valore non risulta applicato (max ~2s);
+                        # feature non rileggibile (None): basta un solo update come prima.
+                        # Niente coalesce: serve uno stato letto dopo il comando
+                        loop = asyncio.get_running_loop()
+                        deadline = loop.time() + 2.0
+                        while True:
+                            await update_hub(dev.parent, hub_locks, what="confirm hub update")
+                            read_value = get_feature_value(dev.features.get(feature_name))
+                            if (previous is None or value_applied(read_value, new_value, previous)
+                                    or loop.time() >= deadline):
+                                break
+                            await asyncio.sleep(0.2)
+
+                        state_json = device_state(dev, state_scratch)
+                        state_topic = f"{base_topic}/{device_name}/state"
+                        enqueue_publish(pub_queue, state_topic, orjson.dumps(state_json))
                 else:
                     logging.warning(f"Feature '{feature_name}' non impostabile su '{device_name}'")
 
@@ -275,15 +441,35 @@ async def handle_mqtt_messages(client, devices, rev_map):
             logging.exception(f"Errore gestione messaggio (topic={topic})")
 
 
+async def publisher_task(client, pub_queue, last_payload, max_batch=64):
+    """Publish degli stati dispositivo: svuota la coda a batch e li invia in parallelo."""
+    while True:
+        batch = [await pub_queue.get()]
+        while len(batch) < max_batch and not pub_queue.empty():
+            batch.append(pub_queue.get_nowait())
+
+        results = await asyncio.gather(
+            *(a_wait_for(client.publish(topic, payload, retain=retain), timeout=10, what=f"publish {topic}")
+              for topic, payload, retain in batch),
+            return_exceptions=True,
+        )
+        for (topic, payload, retain), res in zip(batch, results):
+            if isinstance(res, Exception):
+                # fuori dalla cache: lo stato verrà ripubblicato al prossimo ciclo
+                logging.error(f"Errore publish su {topic}: {res}")
+            elif retain:
+                last_payload[topic] = payload
+
 async def heartbeat_task(client, base_topic, stop_event, sd_notifier=None):
     """Heartbeat su MQTT e (se presente) sd_notify watchdog."""
     status_topic = f"{base_topic}/_bridge/status"
+    heartbeat_topic = f"{base_topic}/_bridge/heartbeat"
 
     # Pubblica stato "online"
     try:
-        await client.publish(status_topic, json.dumps({
+        await client.publish(status_topic, orjson.dumps({
             "status": "online",
-            "ts": datetime.utcnow().isoformat()
+            "ts": datetime.utcnow()
         }), retain=True)
     except Exception:
         logging.warning("Impossibile pubblicare stato 'online' all'avvio.")
@@ -296,9 +482,11 @@ async def heartbeat_task(client, base_topic, stop_event, sd_notifier=None):
             pass
 
     while not stop_event.is_set():
+        # publish diretta (non in coda): il watchdog deve seguire l'esito reale verso il broker
         try:
-            await client.publish(f"{base_topic}/_bridge/heartbeat",
-                                 json.dumps({"ts": datetime.utcnow().isoformat()}),
+            # orjson formatta il datetime in C, stesso output di isoformat()
+            await client.publish(heartbeat_topic,
+                                 orjson.dumps({"ts": datetime.utcnow()}),
                                  retain=False)
 
             # 🔁 invia WATCHDOG=1 ogni ciclo (ogni 15s)
@@ -317,6 +505,15 @@ async def heartbeat_task(client, base_topic, stop_event, sd_notifier=None):
 async def run_once(stop_event):
     """Una sessione completa: connessione MQTT + task fino a disconnessione/errore."""
     kasa_devices, device_map, reverse_device_map = {}, {}, {}
+    # indice ausiliario hub -> figli (chiave: device_id dell'hub), aggiornato dalla discovery
+    hub_refs, hub_to_children = {}, {}
+    hub_locks = {}  # device_id hub -> lock + esito ultimo update, condiviso tra polling e comandi
+    # ultimo payload di stato pubblicato per topic (vale per la sessione MQTT corrente)
+    last_payload = {}
+    # device_id -> dict riusato per costruire lo stato (meno allocazioni tra i cicli)
+    state_scratch = {}
+    # publish in uscita verso publisher_task; limitata per non crescere senza fine a broker lento
+    pub_queue = asyncio.Queue(maxsize=1000)
 
     # opzionale: systemd watchdog
     sd_notifier = None
@@ -328,10 +525,12 @@ async def run_once(stop_event):
         sd_notifier = None
 
     async with aiomqtt.Client(
-        hostname=config['mqtt']['host'],
-        port=config['mqtt']['port'],
-        username=config['mqtt'].get('user'),
-        password=config['mqtt'].get('password')
+        hostname=cfg.mqtt_host,
+        port=cfg.mqtt_port,
+        username=cfg.mqtt_user,
+        password=cfg.mqtt_password,
+        # publish piccoli e frequenti: niente attese di Nagle sul socket
+        socket_options=[(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)],
     ) as client:
         # Aspetta connessione effettiva
         for i in range(10):
@@ -343,33 +542,25 @@ async def run_once(stop_event):
         else:
             logging.info("MQTT connesso e pronto per il polling.")
 
-        base_topic = config['mqtt']['base_topic']
-        discovery = asyncio.create_task(discovery_task(kasa_devices, device_map, reverse_device_map), name="discovery")
-        messages  = asyncio.create_task(handle_mqtt_messages(client, kasa_devices, reverse_device_map), name="mqtt_messages")
-
-        # 👉 avvia il polling solo dopo connessione
-        await asyncio.sleep(1)
-        polling   = asyncio.create_task(poll_kasa_devices(client, kasa_devices, device_map), name="polling")
-        heartbeat = asyncio.create_task(heartbeat_task(client, base_topic, stop_event, sd_notifier), name="heartbeat")
-
-        tasks = [discovery, messages, polling, heartbeat]
-
-        try:
-            # ritorna appena uno dei task termina con eccezione o completion inaspettata
-            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
-            # se un task è terminato (errore o chiusura), cancelliamo il resto
-            for t in pending:
-                t.cancel()
-            await asyncio.gather(*pending, return_exceptions=True)
-            # Propaga eventuali eccezioni
-            for t in done:
-                exc = t.exception()
-                if exc:
-                    raise exc
-        finally:
+        base_topic = cfg.base_topic
+        # TaskGroup: se un task muore con eccezione gli altri vengono cancellati
+        # e l'errore risale (ExceptionGroup) al supervisore in main()
+        async with asyncio.TaskGroup() as tg:
+            tasks = [
+                tg.create_task(discovery_task(kasa_devices, device_map, reverse_device_map, hub_refs, hub_to_children), name="discovery"),
+                tg.create_task(handle_mqtt_messages(client, kasa_devices, reverse_device_map, hub_locks, state_scratch, pub_queue), name="mqtt_messages"),
+                tg.create_task(publisher_task(client, pub_queue, last_payload), name="publisher"),
+            ]
+
+            # 👉 avvia il polling solo dopo connessione
+            await asyncio.sleep(1)
+            tasks.append(tg.create_task(poll_kasa_devices(kasa_devices, device_map, hub_refs, hub_to_children, hub_locks, last_payload, state_scratch, pub_queue), name="polling"))
+            tasks.append(tg.create_task(heartbeat_task(client, base_topic, stop_event, sd_notifier), name="heartbeat"))
+
+            # arresto richiesto: chiudiamo la sessione cancellando tutti i task
+            await stop_event.wait()
             for t in tasks:
                 t.cancel()
-            await asyncio.gather(*tasks, return_exceptions=True)
 
 async def main():
     """Supervisore: mantiene vivo il bridge e gestisce riconnessioni con backoff."""
@@ -404,6 +595,13 @@ async def main():
 if __name__ == "__main__":
     if platform.system() == "Windows":
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    else:
+        # opzionale: event loop libuv, più veloce su socket e timer
+        try:
+            import uvloop  # pip install uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        except ImportError:
+            pass
 
     try:
         asyncio.run(main())